@@ -0,0 +1,57 @@
+# coding: utf-8
+
+"""
+This script belongs to the medenv package
+Copyright (C) 2022 Jeremy Fix
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Standard imports
+import logging
+import datetime
+
+# External imports
+import numpy as np
+import matplotlib.pyplot as plt
+
+# Local imports
+import medenv
+
+logging.basicConfig(level=logging.INFO)
+
+feature = "phytoplankton-carbon-biomass"
+fetcher = medenv.Fetcher([feature])
+
+date = datetime.datetime(year=2012, month=9, day=22, hour=14)
+depth = 6
+
+# Sample the feature over a grid covering the Adriatic sea
+long_values = np.linspace(12.0, 19.0, 40)
+lat_values = np.linspace(40.0, 45.8, 36)
+# The sparse meshgrid only holds a (1, 40) and a (36, 1) arrays
+Xlong, Ylat = np.meshgrid(long_values, lat_values, sparse=True)
+
+# All the grid points are fetched with a single vectorized query
+values, info_values = fetcher.get_values_grid(date, Xlong, Ylat, depth)
+Z = values[feature]
+
+plt.figure()
+plt.pcolormesh(long_values, lat_values, Z, shading="auto")
+plt.colorbar()
+plt.title(f"{feature} at {depth} m on {date:%Y-%m-%d}")
+plt.xlabel("Longitude (degrees east)")
+plt.ylabel("Latitude (degrees north)")
+plt.savefig(f"{feature}.png", bbox_inches="tight")
+logging.info(f"Map saved to {feature}.png")
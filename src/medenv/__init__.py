@@ -25,6 +25,9 @@ from datetime import datetime
 import functools
 from typing import Union
 
+# External imports
+import numpy as np
+
 logging.getLogger("medenv").addHandler(logging.NullHandler())
 
 
@@ -32,6 +35,7 @@ logging.getLogger("medenv").addHandler(logging.NullHandler())
 from medenv import etopo
 from medenv import woa
 from medenv import cmems
+from medenv import utils
 
 
 class Fetcher:
@@ -43,7 +47,10 @@ class Fetcher:
 
     def __init__(self, features, reduction=None):
         self.features = features
+        self.reduction = reduction
         self.getters = {}
+        self.grid_getters = {}
+        self.interp_getters = {}
         self.cmems_getter = None
         for f in features:
             if f not in Fetcher._available_features:
@@ -51,16 +58,32 @@ class Fetcher:
                     f"The feature {f} is not in the available features {Fetcher._available_features}"
                 )
 
-            if f in list(cmems.CMEMS._feature_params.keys()):
+            if f in cmems.CMEMS._feature_params:
                 if self.cmems_getter is None:
                     self.cmems_getter = cmems.CMEMS()
                 self.getters[f] = functools.partial(
                     self.cmems_getter.get_value, what=f, reduction=reduction
                 )
+                self.grid_getters[f] = functools.partial(
+                    self.cmems_getter.get_values_grid, what=f
+                )
+                self.interp_getters[f] = functools.partial(
+                    self.cmems_getter.interp, what=f
+                )
             elif f == "bathymetry":
                 self.getters[f] = lambda date, long_lat, depth: etopo.get_value(
                     long_lat[0], long_lat[1]
                 )
+                self.grid_getters[
+                    f
+                ] = lambda date, long_values, lat_values, depth: etopo.get_values_grid(
+                    long_values, lat_values
+                )
+                self.interp_getters[
+                    f
+                ] = lambda date, long_values, lat_values, depth: etopo.interp(
+                    long_values, lat_values
+                )
             elif f == "sea-surface-temperature":
                 if self.cmems_getter is None:
                     self.cmems_getter = cmems.CMEMS()
@@ -73,6 +96,24 @@ class Fetcher:
                     what="temperature",
                     reduction=reduction,
                 )
+                self.grid_getters[
+                    f
+                ] = lambda date, long_values, lat_values, depth: self.cmems_getter.get_values_grid(
+                    date=date,
+                    long_values=long_values,
+                    lat_values=lat_values,
+                    depth=0,
+                    what="temperature",
+                )
+                self.interp_getters[
+                    f
+                ] = lambda date, long_values, lat_values, depth: self.cmems_getter.interp(
+                    date=date,
+                    long_values=long_values,
+                    lat_values=lat_values,
+                    depth=0,
+                    what="temperature",
+                )
             elif f == "sea-surface-salinity":
                 if self.cmems_getter is None:
                     self.cmems_getter = cmems.CMEMS()
@@ -85,6 +126,24 @@ class Fetcher:
                     what="salinity",
                     reduction=reduction,
                 )
+                self.grid_getters[
+                    f
+                ] = lambda date, long_values, lat_values, depth: self.cmems_getter.get_values_grid(
+                    date=date,
+                    long_values=long_values,
+                    lat_values=lat_values,
+                    depth=0,
+                    what="salinity",
+                )
+                self.interp_getters[
+                    f
+                ] = lambda date, long_values, lat_values, depth: self.cmems_getter.interp(
+                    date=date,
+                    long_values=long_values,
+                    lat_values=lat_values,
+                    depth=0,
+                    what="salinity",
+                )
 
     def get_values(
         self,
@@ -93,8 +152,89 @@ class Fetcher:
         depth: Union[float, tuple[float, float]],
         reduction=None,
     ):
+        # The cmems features are fetched together so that the ones
+        # sharing the same dataset are sliced with a single request
+        cmems_features = [f for f in self.features if f in cmems.CMEMS._feature_params]
+        if cmems_features:
+            logging.info(f"Fetching {', '.join(cmems_features)}")
+            cmems_values, cmems_infos = self.cmems_getter.get_values_multi(
+                date, long_lat, depth, cmems_features, self.reduction
+            )
+
+        values, infos = {}, {}
+        for f in self.features:
+            if f in cmems_features:
+                values[f], infos[f] = cmems_values[f], cmems_infos[f]
+            else:
+                logging.info(f"Fetching {f} ")
+                values[f], infos[f] = self.getters[f](date, long_lat, depth)
+        return values, infos
+
+    def get_values_many(
+        self,
+        date: Union[datetime, tuple[datetime, datetime]],
+        long_lats: list[tuple[float, float]],
+        depth: Union[float, tuple[float, float]],
+        workers: int = 16,
+    ):
+        """
+        Fetch the features at many (longitude, latitude), e.g. along
+        a trajectory, with at most workers locations fetched concurrently.
+        As every location requests its CMEMS datasets concurrently, up to
+        workers times the number of datasets requests may run at once.
+
+        Returns the list of the (values, infos) of every long_lat, in order
+        """
+        return utils.parallel_threads(
+            lambda long_lat: self.get_values(date, long_lat, depth),
+            long_lats,
+            workers=workers,
+        )
+
+    def get_values_grid(
+        self,
+        date: datetime,
+        long_values: np.ndarray,
+        lat_values: np.ndarray,
+        depth: float,
+    ):
+        """
+        Fetch the features at many (longitude, latitude) points at once,
+        e.g. on a meshgrid. For every feature, the values are returned
+        as an array of the broadcasted shape of long_values and lat_values,
+        so that a sparse meshgrid can be provided.
+        """
+        long_values = np.asarray(long_values)
+        lat_values = np.asarray(lat_values)
+        num_points = np.broadcast(long_values, lat_values).size
+        values, infos = {}, {}
+        for f in self.features:
+            logging.info(f"Fetching {f} on {num_points} points")
+            values[f], infos[f] = self.grid_getters[f](
+                date, long_values, lat_values, depth
+            )
+        return values, infos
+
+    def interp(
+        self,
+        date: datetime,
+        long_values: np.ndarray,
+        lat_values: np.ndarray,
+        depth: float,
+    ):
+        """
+        Linearly interpolate the features at many (longitude, latitude)
+        points at once. Compared to get_values_grid, which takes the values
+        at the closest grid nodes, the values are interpolated between the
+        grid nodes, in longitude, latitude and depth.
+        """
+        long_values = np.asarray(long_values)
+        lat_values = np.asarray(lat_values)
+        num_points = np.broadcast(long_values, lat_values).size
         values, infos = {}, {}
         for f in self.features:
-            logging.info(f"Fetching {f} ")
-            values[f], infos[f] = self.getters[f](date, long_lat, depth)
+            logging.info(f"Interpolating {f} on {num_points} points")
+            values[f], infos[f] = self.interp_getters[f](
+                date, long_values, lat_values, depth
+            )
         return values, infos
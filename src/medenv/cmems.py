@@ -18,18 +18,148 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 # Standard imports
+import asyncio
+import contextlib
 import logging
 import datetime
+from dataclasses import dataclass
+import functools
 import os
+import tempfile
+import threading
+import time
 from typing import Union
 
 # External modules
 import getpass
+import aiohttp
 import numpy as np
+import requests
 import xarray as xr
+from scipy.spatial import cKDTree
 import copernicusmarine
 from copernicusmarine.core_functions.models import DEFAULT_SUBSET_METHOD, SubsetMethod
 
+# Local imports
+from medenv import utils
+
+# The first dates of the physical (med-cmcc) and biogeochemical (med-ogs)
+# reanalyses
+_DATE_LIMIT_PHY = datetime.datetime(1987, 1, 1)
+_DATE_LIMIT_BGC = datetime.datetime(1999, 1, 1)
+
+
+# The failures worth retrying : network errors and timeouts
+_TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    asyncio.TimeoutError,
+    requests.ConnectionError,
+    requests.Timeout,
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientPayloadError,
+)
+
+
+def _is_transient(error):
+    # Among the HTTP errors, only the server side ones and the rate
+    # limiting are worth retrying
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status >= 500 or status == 429
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    return isinstance(error, _TRANSIENT_ERRORS)
+
+
+@dataclass(frozen=True, slots=True)
+class FeatureSpec:
+    """
+    The description of a feature, i.e. the dataset and variable to request
+    """
+
+    dataset_id: str
+    variable: str
+    slice_mode: str
+    has_depth: bool
+    date_limit: datetime.datetime
+
+
+def _check_date_limit(what, params, date):
+    # From 1987 to present
+    if (isinstance(date, tuple) and date[0] < params.date_limit) or (
+        not isinstance(date, tuple) and date < params.date_limit
+    ):
+        raise ValueError(f"Cannot get {what} before {params.date_limit}")
+
+
+def _check_date_end(what, ds, date):
+    # The nearest selection would silently take the last available date
+    last_date = ds["time"].values.max()
+    if np.datetime64(date) > last_date:
+        raise ValueError(f"Cannot get {what} after {last_date}")
+
+
+def _build_selectors(date, long_lat, depth, has_depth):
+    """
+    Build the subset parameters of a request to copernicusmarine
+    """
+    params = {}
+    if isinstance(long_lat[0], tuple):
+        params["minimum_longitude"] = long_lat[0][0]
+        params["maximum_longitude"] = long_lat[0][1]
+    else:
+        params["minimum_longitude"] = long_lat[0]
+        params["maximum_longitude"] = long_lat[0]
+    if isinstance(long_lat[1], tuple):
+        params["minimum_latitude"] = long_lat[1][0]
+        params["maximum_latitude"] = long_lat[1][1]
+    else:
+        params["minimum_latitude"] = long_lat[1]
+        params["maximum_latitude"] = long_lat[1]
+
+    if has_depth:
+        if isinstance(depth, tuple):
+            params["minimum_depth"] = depth[0]
+            params["maximum_depth"] = depth[1]
+        else:
+            params["minimum_depth"] = depth
+            params["maximum_depth"] = depth
+
+    if isinstance(date, tuple):
+        params["start_datetime"] = date[0]
+        params["end_datetime"] = date[1]
+    else:
+        params["start_datetime"] = date
+        params["end_datetime"] = date
+    return params
+
+
+def _load_coordinates(filepath):
+    with np.load(filepath) as data:
+        return {k: data[k] for k in data.files}
+
+
+def _grid_signature(coords):
+    # A cheap validator of a grid : the sizes and endpoints of its coordinates
+    return {k: (len(v), float(v[0]), float(v[-1])) for k, v in coords.items()}
+
+
+def _within_grid(vals, target):
+    # Whether the target falls within the grid, up to half a grid step
+    # beyond its first and last nodes
+    vmin, vmax = vals.min(), vals.max()
+    tolerance = (vmax - vmin) / (2 * (len(vals) - 1)) if len(vals) > 1 else 0
+    return vmin - tolerance <= target <= vmax + tolerance
+
+
+def _spatial_keys(ds):
+    # Depending on the dataset, the spatial coordinates are either
+    # named lon/lat or longitude/latitude
+    if "longitude" in ds.dims:
+        return "longitude", "latitude"
+    return "lon", "lat"
+
 
 class CMEMS(object):
     # Datasets used for accessing the measurements
@@ -38,135 +168,137 @@ class CMEMS(object):
     # med-ogs :
     # https://resources.marine.copernicus.eu/product-detail/MEDSEA_MULTIYEAR_BGC_006_008/INFORMATION
     _feature_params = {
-        "temperature": {
-            "dataset_id": "med-cmcc-tem-rean-d",
-            "variable": "thetao",
-            "slice_mode": "lon-lat",
-            "has_depth": True,
-            "date_limit": datetime.datetime.strptime("01-01-1987", "%d-%m-%Y"),
-        },
-        "salinity": {
-            "dataset_id": "med-cmcc-sal-rean-d",
-            "variable": "so",
-            "slice_mode": "lon-lat",
-            "has_depth": True,
-            "date_limit": datetime.datetime.strptime("01-01-1987", "%d-%m-%Y"),
-        },
-        "eastward-water-velocity": {
-            "dataset_id": "med-cmcc-cur-rean-d",
-            "variable": "uo",
-            "slice_mode": "lon-lat",
-            "has_depth": True,
-            "date_limit": datetime.datetime.strptime("01-01-1987", "%d-%m-%Y"),
-        },
-        "northward-water-velocity": {
-            "dataset_id": "med-cmcc-cur-rean-d",
-            "variable": "vo",
-            "slice_mode": "lon-lat",
-            "has_depth": True,
-            "date_limit": datetime.datetime.strptime("01-01-1987", "%d-%m-%Y"),
-        },
-        "mixed-layer-thickness": {
-            "dataset_id": "med-cmcc-mld-rean-d",
-            "variable": "mlotst",
-            "slice_mode": "lon-lat",
-            "has_depth": False,
-            "date_limit": datetime.datetime.strptime("01-01-1987", "%d-%m-%Y"),
-        },
-        "sea-surface-above-geoid": {
-            "dataset_id": "med-cmcc-ssh-rean-d",
-            "variable": "zos",
-            "slice_mode": "lon-lat",
-            "has_depth": False,
-            "date_limit": datetime.datetime.strptime("01-01-1987", "%d-%m-%Y"),
-        },
-        "phytoplankton-carbon-biomass": {
-            "dataset_id": "med-ogs-pft-rean-d",
-            "variable": "phyc",
-            "slice_mode": "longitude-latitude",
-            "has_depth": True,
-            "date_limit": datetime.datetime.strptime("01-01-1999", "%d-%m-%Y"),
-        },
-        "chlorophyl-a": {
-            "dataset_id": "med-ogs-pft-rean-d",
-            "variable": "chl",
-            "slice_mode": "longitude-latitude",
-            "has_depth": True,
-            "date_limit": datetime.datetime.strptime("01-01-1999", "%d-%m-%Y"),
-        },
-        "nitrate": {
-            "dataset_id": "med-ogs-nut-rean-d",
-            "variable": "no3",
-            "slice_mode": "longitude-latitude",
-            "has_depth": True,
-            "date_limit": datetime.datetime.strptime("01-01-1999", "%d-%m-%Y"),
-        },
-        "phosphate": {
-            "dataset_id": "med-ogs-nut-rean-d",
-            "variable": "po4",
-            "slice_mode": "longitude-latitude",
-            "has_depth": True,
-            "date_limit": datetime.datetime.strptime("01-01-1999", "%d-%m-%Y"),
-        },
-        "ammonium": {
-            "dataset_id": "med-ogs-nut-rean-d",
-            "variable": "nh4",
-            "slice_mode": "longitude-latitude",
-            "has_depth": True,
-            "date_limit": datetime.datetime.strptime("01-01-1999", "%d-%m-%Y"),
-        },
-        "net-primary-production": {
-            "dataset_id": "med-ogs-bio-rean-d",
-            "variable": "nppv",
-            "slice_mode": "longitude-latitude",
-            "has_depth": True,
-            "date_limit": datetime.datetime.strptime("01-01-1999", "%d-%m-%Y"),
-        },
-        "oxygen": {
-            "dataset_id": "med-ogs-bio-rean-d",
-            "variable": "o2",
-            "slice_mode": "longitude-latitude",
-            "has_depth": True,
-            "date_limit": datetime.datetime.strptime("01-01-1999", "%d-%m-%Y"),
-        },
-        "ph": {
-            "dataset_id": "med-ogs-car-rean-d",
-            "variable": "ph",
-            "slice_mode": "longitude-latitude",
-            "has_depth": True,
-            "date_limit": datetime.datetime.strptime("01-01-1999", "%d-%m-%Y"),
-        },
-        "dissolved-inorganic-carbon": {
-            "dataset_id": "med-ogs-car-rean-d",
-            "variable": "dissic",
-            "slice_mode": "longitude-latitude",
-            "has_depth": True,
-            "date_limit": datetime.datetime.strptime("01-01-1999", "%d-%m-%Y"),
-        },
-        "alkalinity": {
-            "dataset_id": "med-ogs-car-rean-d",
-            "variable": "talk",
-            "slice_mode": "longitude-latitude",
-            "has_depth": True,
-            "date_limit": datetime.datetime.strptime("01-01-1999", "%d-%m-%Y"),
-        },
-        "surface-partial-pressure-co2": {
-            "dataset_id": "med-ogs-co2-rean-d",
-            "variable": "spco2",
-            "slice_mode": "longitude-latitude",
-            "has_depth": False,
-            "date_limit": datetime.datetime.strptime("01-01-1999", "%d-%m-%Y"),
-        },
-        "surface-co2-flux": {
-            "dataset_id": "med-ogs-co2-rean-d",
-            "variable": "fpco2",
-            "slice_mode": "longitude-latitude",
-            "has_depth": False,
-            "date_limit": datetime.datetime.strptime("01-01-1999", "%d-%m-%Y"),
-        },
+        "temperature": FeatureSpec(
+            dataset_id="med-cmcc-tem-rean-d",
+            variable="thetao",
+            slice_mode="lon-lat",
+            has_depth=True,
+            date_limit=_DATE_LIMIT_PHY,
+        ),
+        "salinity": FeatureSpec(
+            dataset_id="med-cmcc-sal-rean-d",
+            variable="so",
+            slice_mode="lon-lat",
+            has_depth=True,
+            date_limit=_DATE_LIMIT_PHY,
+        ),
+        "eastward-water-velocity": FeatureSpec(
+            dataset_id="med-cmcc-cur-rean-d",
+            variable="uo",
+            slice_mode="lon-lat",
+            has_depth=True,
+            date_limit=_DATE_LIMIT_PHY,
+        ),
+        "northward-water-velocity": FeatureSpec(
+            dataset_id="med-cmcc-cur-rean-d",
+            variable="vo",
+            slice_mode="lon-lat",
+            has_depth=True,
+            date_limit=_DATE_LIMIT_PHY,
+        ),
+        "mixed-layer-thickness": FeatureSpec(
+            dataset_id="med-cmcc-mld-rean-d",
+            variable="mlotst",
+            slice_mode="lon-lat",
+            has_depth=False,
+            date_limit=_DATE_LIMIT_PHY,
+        ),
+        "sea-surface-above-geoid": FeatureSpec(
+            dataset_id="med-cmcc-ssh-rean-d",
+            variable="zos",
+            slice_mode="lon-lat",
+            has_depth=False,
+            date_limit=_DATE_LIMIT_PHY,
+        ),
+        "phytoplankton-carbon-biomass": FeatureSpec(
+            dataset_id="med-ogs-pft-rean-d",
+            variable="phyc",
+            slice_mode="longitude-latitude",
+            has_depth=True,
+            date_limit=_DATE_LIMIT_BGC,
+        ),
+        "chlorophyl-a": FeatureSpec(
+            dataset_id="med-ogs-pft-rean-d",
+            variable="chl",
+            slice_mode="longitude-latitude",
+            has_depth=True,
+            date_limit=_DATE_LIMIT_BGC,
+        ),
+        "nitrate": FeatureSpec(
+            dataset_id="med-ogs-nut-rean-d",
+            variable="no3",
+            slice_mode="longitude-latitude",
+            has_depth=True,
+            date_limit=_DATE_LIMIT_BGC,
+        ),
+        "phosphate": FeatureSpec(
+            dataset_id="med-ogs-nut-rean-d",
+            variable="po4",
+            slice_mode="longitude-latitude",
+            has_depth=True,
+            date_limit=_DATE_LIMIT_BGC,
+        ),
+        "ammonium": FeatureSpec(
+            dataset_id="med-ogs-nut-rean-d",
+            variable="nh4",
+            slice_mode="longitude-latitude",
+            has_depth=True,
+            date_limit=_DATE_LIMIT_BGC,
+        ),
+        "net-primary-production": FeatureSpec(
+            dataset_id="med-ogs-bio-rean-d",
+            variable="nppv",
+            slice_mode="longitude-latitude",
+            has_depth=True,
+            date_limit=_DATE_LIMIT_BGC,
+        ),
+        "oxygen": FeatureSpec(
+            dataset_id="med-ogs-bio-rean-d",
+            variable="o2",
+            slice_mode="longitude-latitude",
+            has_depth=True,
+            date_limit=_DATE_LIMIT_BGC,
+        ),
+        "ph": FeatureSpec(
+            dataset_id="med-ogs-car-rean-d",
+            variable="ph",
+            slice_mode="longitude-latitude",
+            has_depth=True,
+            date_limit=_DATE_LIMIT_BGC,
+        ),
+        "dissolved-inorganic-carbon": FeatureSpec(
+            dataset_id="med-ogs-car-rean-d",
+            variable="dissic",
+            slice_mode="longitude-latitude",
+            has_depth=True,
+            date_limit=_DATE_LIMIT_BGC,
+        ),
+        "alkalinity": FeatureSpec(
+            dataset_id="med-ogs-car-rean-d",
+            variable="talk",
+            slice_mode="longitude-latitude",
+            has_depth=True,
+            date_limit=_DATE_LIMIT_BGC,
+        ),
+        "surface-partial-pressure-co2": FeatureSpec(
+            dataset_id="med-ogs-co2-rean-d",
+            variable="spco2",
+            slice_mode="longitude-latitude",
+            has_depth=False,
+            date_limit=_DATE_LIMIT_BGC,
+        ),
+        "surface-co2-flux": FeatureSpec(
+            dataset_id="med-ogs-co2-rean-d",
+            variable="fpco2",
+            slice_mode="longitude-latitude",
+            has_depth=False,
+            date_limit=_DATE_LIMIT_BGC,
+        ),
     }
 
-    def __init__(self, num_retries=10):
+    def __init__(self, num_retries=10, cache_coords=True):
+        if num_retries < 1:
+            raise ValueError(f"num_retries must be at least 1, got {num_retries}")
         # https://help.marine.copernicus.eu/en/articles/8287609-copernicus-marine-toolbox-api-open-a-dataset-or-read-a-dataframe-remotely
         # Copernicus Marine Toolbox API - Open a dataset or read a dataframe remotely
         username = os.getenv("CMEMS_USERNAME")
@@ -188,6 +320,262 @@ class CMEMS(object):
 
         logging.info("Connection to cmems successfull")
 
+        self.num_retries = num_retries
+
+        # The lazily opened datasets, indexed by their dataset_id
+        self.datastores = {}
+        # One lock per dataset_id, so that the datasets are opened concurrently
+        # but each of them only once
+        self._datastore_locks = {}
+        self._datastore_locks_lock = threading.Lock()
+        # The spatial coordinates of the datasets used for snapping the point
+        # queries, indexed by their dataset_id. They are also persisted on disk
+        # if cache_coords is True
+        self.coordinates = {}
+        self.cache_coords = cache_coords
+        # The KD-trees of the (longitude, latitude) grid nodes,
+        # indexed by dataset_id, built on the first ball query
+        self._trees = {}
+        # Memoization of the point queries, which are snapped to the grid nodes
+        self._cached_slice = functools.lru_cache(maxsize=200_000)(self._slice)
+        # The arguments of the memoized point queries. As the evictions of
+        # the cache are not tracked, it only hints which queries are cached
+        self._sliced_keys = set()
+        # The features sliced at a fixed date and depth, reused by the
+        # repeated grid and ball queries
+        self._cached_freeze = functools.lru_cache(maxsize=32)(self._freeze)
+
+    def _with_retries(self, f, lock=None, **kwargs):
+        """
+        Call f, making at most num_retries attempts with an exponential
+        backoff if the request fails with a transient network error.
+        If given, the lock is held during each attempt but not while waiting
+        """
+        for attempt in range(self.num_retries):
+            try:
+                with lock or contextlib.nullcontext():
+                    return f(**kwargs)
+            except Exception as e:
+                if not _is_transient(e) or attempt == self.num_retries - 1:
+                    raise
+                delay = min(2**attempt, 60)
+                logging.warning(f"Request to cmems failed ({e}), retrying in {delay}s")
+            time.sleep(delay)
+
+    def fetch(self, dataset_id: str):
+        """
+        Return the dataset for the given dataset_id, opening it remotely
+        only on the first request. The data are only downloaded when needed.
+        """
+        if dataset_id in self.datastores:
+            return self.datastores[dataset_id]
+
+        def open_dataset():
+            if dataset_id not in self.datastores:
+                logging.info(f"Opening the dataset {dataset_id}")
+                ds = copernicusmarine.open_dataset(dataset_id=dataset_id)
+                # Drop duplicated indices, once for all the requests
+                # This happens for example with oxygen, nppv, ph, alkalinity, dissic
+                ds = ds.drop_duplicates(dim=...)
+                self._update_coordinates(dataset_id, ds)
+                self.datastores[dataset_id] = ds
+            return self.datastores[dataset_id]
+
+        with self._datastore_locks_lock:
+            lock = self._datastore_locks.setdefault(dataset_id, threading.Lock())
+        # The lock prevents several threads from opening the same dataset
+        return self._with_retries(open_dataset, lock=lock)
+
+    def get_coordinates(self, dataset_id: str):
+        """
+        Return the longitude, latitude and depth coordinates of a dataset.
+
+        These coordinates are only used to snap the point queries to the
+        grid nodes. They are saved in the medenv directory and loaded from
+        there on the next runs, so that snapping does not need to open the
+        remote dataset. Whenever the dataset does get opened, the cached
+        coordinates are checked against its grid and updated if it changed.
+        The time coordinates, which grow as the dataset is updated, are not cached.
+        """
+        if dataset_id in self.coordinates:
+            return self.coordinates[dataset_id]
+
+        filepath = self._coordinates_path(dataset_id)
+        if self.cache_coords and filepath.exists():
+            logging.debug(f"Loading the coordinates of {dataset_id} from {filepath}")
+            self.coordinates[dataset_id] = _load_coordinates(filepath)
+        else:
+            # Opening the dataset fills in its coordinates
+            self.fetch(dataset_id)
+        return self.coordinates[dataset_id]
+
+    def _coordinates_path(self, dataset_id):
+        return utils._BASEDIR / "cmems" / f"{dataset_id}-coords.npz"
+
+    def _update_coordinates(self, dataset_id, ds):
+        """
+        Set the coordinates of a freshly opened dataset, updating the
+        coordinates saved on disk if they are missing or stale
+        """
+        key_lon, key_lat = _spatial_keys(ds)
+        coords = {
+            "longitude": ds[key_lon].values,
+            "latitude": ds[key_lat].values,
+        }
+        if "depth" in ds.dims:
+            coords["depth"] = ds["depth"].values
+
+        filepath = self._coordinates_path(dataset_id)
+        previous = self.coordinates.get(dataset_id)
+        if previous is None and self.cache_coords and filepath.exists():
+            previous = _load_coordinates(filepath)
+        is_stale = False
+        if previous is not None:
+            is_stale = _grid_signature(previous) != _grid_signature(coords)
+        if is_stale:
+            logging.warning(f"The grid of {dataset_id} changed, updating the cache")
+        if self.cache_coords and (previous is None or is_stale):
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            # The file is written aside and moved in place so that concurrent
+            # readers never load a partially written file
+            with tempfile.NamedTemporaryFile(
+                dir=filepath.parent, suffix=".npz", delete=False
+            ) as f:
+                np.savez(f, **coords)
+            os.replace(f.name, filepath)
+            logging.debug(f"Coordinates of {dataset_id} saved to {filepath}")
+        self.coordinates[dataset_id] = coords
+
+    def _slice(
+        self,
+        dataset_id,
+        variables,
+        date,
+        long_lat,
+        depth,
+        has_depth,
+        reduction=None,
+        selectors=None,
+    ):
+        """
+        Slice several variables of the same dataset with a single request.
+        The subset parameters of the request can be given as selectors,
+        otherwise they are built from the date, position and depth.
+
+        Returns a dictionnary of the values indexed by variable name
+        and the selected coordinates
+        """
+        if reduction == "mean":
+            # The mean does not need the dataframe of all the values
+            return self._slice_mean(
+                dataset_id, variables, date, long_lat, depth, has_depth
+            )
+
+        subset_method = DEFAULT_SUBSET_METHOD
+
+        params = selectors or _build_selectors(date, long_lat, depth, has_depth)
+
+        df_values = self._with_retries(
+            copernicusmarine.read_dataframe,
+            dataset_id=dataset_id,
+            variables=list(variables),
+            subset_method=subset_method,
+            **params,
+        )
+
+        # The noslice coordinates will appear as columns
+        # we reset the index to get all the dimensions as columns
+        df_values.reset_index(inplace=True)
+
+        if not has_depth:
+            # In this case, where a dataset cannot be indexed by depth
+            # we simply ignore the depth and fill in the value we got
+            # possibly at the surface
+            df_values["depth"] = depth
+
+        # before defining our own expected ordering of the dimensions
+        df_values.set_index(["time", "longitude", "latitude", "depth"], inplace=True)
+
+        # Ensure we always have longitude and latitude for spatial
+        # coordinates
+        df_values.index.rename(["time", "longitude", "latitude", "depth"], inplace=True)
+        results = {v: df_values[[v]] for v in variables}
+
+        time_coords = np.unique(df_values.index.get_level_values("time").to_numpy())
+        longitude_coords = np.unique(
+            df_values.index.get_level_values("longitude").to_numpy()
+        )
+        latitude_coords = np.unique(
+            df_values.index.get_level_values("latitude").to_numpy()
+        )
+        depth_coords = np.unique(df_values.index.get_level_values("depth").to_numpy())
+
+        selected_coordinates = {
+            "time": time_coords,
+            "longitude": longitude_coords,
+            "latitude": latitude_coords,
+            "depth": depth_coords if has_depth else float("nan"),
+        }
+        return results, selected_coordinates
+
+    def _slice_mean(self, dataset_id, variables, date, long_lat, depth, has_depth):
+        """
+        Compute the mean of several variables of the same dataset directly
+        from the lazily opened dataset, without building any dataframe
+        """
+        ds = self.fetch(dataset_id)[list(variables)]
+        key_lon, key_lat = _spatial_keys(ds)
+
+        # The ranges are sliced and the single values are
+        # selected from the closest coordinates
+        nearests = {}
+        selections = [(key_lon, long_lat[0]), (key_lat, long_lat[1]), ("time", date)]
+        if has_depth:
+            selections.append(("depth", depth))
+        for key, request in selections:
+            # As copernicusmarine, the requests not overlapping the spatial
+            # and temporal bounds of the dataset are rejected instead of
+            # silently averaging its edge
+            bounds = request if isinstance(request, tuple) else (request, request)
+            lower, upper = (
+                np.datetime64(b) if isinstance(b, datetime.datetime) else b
+                for b in bounds
+            )
+            vals = ds[key].values
+            if key != "depth" and (upper < vals.min() or lower > vals.max()):
+                raise ValueError(
+                    f"The requested {key} {request} is outside of the bounds "
+                    f"[{vals.min()}, {vals.max()}] of the dataset {dataset_id}"
+                )
+            if isinstance(request, tuple):
+                sliced = ds.sel({key: slice(request[0], request[1])})
+                if sliced.sizes[key] == 0:
+                    # As the nearest subset method of copernicusmarine, a range
+                    # falling between two grid nodes is replaced by the node
+                    # closest to its start
+                    closest = ds[key].sel({key: request[0]}, method="nearest").values
+                    sliced = ds.sel({key: slice(closest, closest)})
+                ds = sliced
+            else:
+                nearests[key] = request
+        values = ds.sel(nearests, method="nearest")
+
+        # The datasets are lazily loaded by chunks, the means of all the
+        # variables are computed at once, loading the chunks in parallel
+        # As the mean of the dataframe, the mean ignores the missing values,
+        # e.g. on land
+        means = values.mean(skipna=True).compute(
+            scheduler="threads", num_workers=os.cpu_count()
+        )
+        results = {v: float(means[v]) for v in variables}
+        selected_coordinates = {
+            "time": np.unique(values["time"].values),
+            "longitude": np.unique(values[key_lon].values),
+            "latitude": np.unique(values[key_lat].values),
+            "depth": np.unique(values["depth"].values) if has_depth else float("nan"),
+        }
+        return results, selected_coordinates
+
     def get_value(
         self,
         date: Union[datetime.datetime, tuple[datetime.datetime, datetime.datetime]],
@@ -196,114 +584,362 @@ class CMEMS(object):
         what: str,
         reduction=None,
     ):
-        def f_slice(dataset_id, variable, date, long_lat, depth, has_depth):
-            subset_method = DEFAULT_SUBSET_METHOD
-
-            params = {}
-            if isinstance(long_lat[0], tuple):
-                params["minimum_longitude"] = long_lat[0][0]
-                params["maximum_longitude"] = long_lat[0][1]
-            else:
-                params["minimum_longitude"] = long_lat[0]
-                params["maximum_longitude"] = long_lat[0]
-            if isinstance(long_lat[1], tuple):
-                params["minimum_latitude"] = long_lat[1][0]
-                params["maximum_latitude"] = long_lat[1][1]
-            else:
-                params["minimum_latitude"] = long_lat[1]
-                params["maximum_latitude"] = long_lat[1]
-
-            if has_depth:
-                if isinstance(depth, tuple):
-                    params["minimum_depth"] = depth[0]
-                    params["maximum_depth"] = depth[1]
-                else:
-                    params["minimum_depth"] = depth
-                    params["maximum_depth"] = depth
-
-            if isinstance(date, tuple):
-                params["start_datetime"] = date[0]
-                params["end_datetime"] = date[1]
-            else:
-                params["start_datetime"] = date
-                params["end_datetime"] = date
-
-            # Drop duplicated indices
-            # This happens for example with oxygen, nppv, ph, alkalinity, dissic
-            # ds = ds.drop_duplicates(dim=...)
-
-            df_values = copernicusmarine.read_dataframe(
-                dataset_id=dataset_id,
-                variables=[variable],
-                subset_method=subset_method,
-                **params,
-            )
+        values, infos = self.get_values_multi(date, long_lat, depth, [what], reduction)
+        return values[what], infos[what]
 
-            # The noslice coordinates will appear as columns
-            # we reset the index to get all the dimensions as columns
-            df_values.reset_index(inplace=True)
+    def get_values_multi(
+        self,
+        date: Union[datetime.datetime, tuple[datetime.datetime, datetime.datetime]],
+        long_lat: tuple[float, float],
+        depth: Union[float, tuple[float, float]],
+        whats: list[str],
+        reduction=None,
+    ):
+        """
+        Fetch several features at once. The features sharing the same
+        dataset are grouped and sliced with a single request.
 
-            if not has_depth:
-                # In this case, where a dataset cannot be indexed by depth
-                # we simply ignore the depth and fill in the value we got
-                # possibly at the surface
-                df_values["depth"] = depth
+        Returns the dictionnaries of the values and of the selected
+        coordinates, indexed by feature name
+        """
+        if not whats:
+            return {}, {}
 
-            # before defining our own expected ordering of the dimensions
-            df_values.set_index(
-                ["time", "longitude", "latitude", "depth"], inplace=True
-            )
+        # Group the features by dataset
+        buckets = {}
+        for what in whats:
+            params = CMEMS._feature_params.get(what)
+            if params is None:
+                raise ValueError(
+                    f"Does not know which dataset to download for the key {what}"
+                )
+            _check_date_limit(what, params, date)
+            buckets.setdefault(params.dataset_id, []).append(what)
 
-            # Ensure we always have longitude and latitude for spatial
-            # coordinates
-            df_values.index.rename(
-                ["time", "longitude", "latitude", "depth"], inplace=True
-            )
-            if reduction == "mean":
-                result = df_values.mean().item()
-            else:
-                result = df_values
+        is_point_query = reduction is None and not (
+            isinstance(date, tuple)
+            or isinstance(depth, tuple)
+            or isinstance(long_lat[0], tuple)
+            or isinstance(long_lat[1], tuple)
+        )
 
-            time_coords = np.unique(df_values.index.get_level_values("time").to_numpy())
-            longitude_coords = np.unique(
-                df_values.index.get_level_values("longitude").to_numpy()
-            )
-            latitude_coords = np.unique(
-                df_values.index.get_level_values("latitude").to_numpy()
-            )
-            depth_coords = np.unique(
-                df_values.index.get_level_values("depth").to_numpy()
-            )
+        def snapped_key(dataset_bucket):
+            # The arguments of the memoized slice of a point query, or None
+            # if the query is not memoized
+            dataset_id, bucket = dataset_bucket
+            params = CMEMS._feature_params[bucket[0]]
+            variables = tuple(CMEMS._feature_params[w].variable for w in bucket)
+            # Point queries are snapped to the closest grid node so that
+            # all the queries falling in the same cell share their result
+            snapped = is_point_query and self._snap_to_grid(params, long_lat, depth)
+            if not snapped:
+                return None
+            return (dataset_id, variables, date, *snapped, params.has_depth)
 
-            selected_coordinates = {
-                "time": time_coords,
-                "longitude": longitude_coords,
-                "latitude": latitude_coords,
-                "depth": depth_coords if has_depth else float("nan"),
+        def cached_slice(key):
+            results, selected_coordinates = self._cached_slice(*key)
+            if len(self._sliced_keys) >= self._cached_slice.cache_info().maxsize:
+                self._sliced_keys.clear()
+            self._sliced_keys.add(key)
+            # The cached objects are shared by all the queries of the
+            # cell, the caller gets copies it is free to modify
+            return {v: df.copy() for v, df in results.items()}, {
+                k: np.copy(c) if isinstance(c, np.ndarray) else c
+                for k, c in selected_coordinates.items()
             }
-            return result, selected_coordinates
-
-        # Get access to the datastore
-        if what in CMEMS._feature_params.keys():
-            params = CMEMS._feature_params[what]
-
-            # From 1987 to present
-            if (isinstance(date, tuple) and date[0] < params["date_limit"]) or (
-                not isinstance(date, tuple) and date < params["date_limit"]
-            ):
-                raise ValueError(f"Cannot get {what} before {params['date_limit']}")
-            # datastore = self.fetch(params["prefix"], params["dataset"])
-            logging.info(f"Slicing for {params['variable']}")
-
-            return f_slice(
-                params["dataset_id"],
-                params["variable"],
+
+        def slice_bucket(dataset_bucket):
+            dataset_id, bucket = dataset_bucket
+            params = CMEMS._feature_params[bucket[0]]
+            variables = tuple(CMEMS._feature_params[w].variable for w in bucket)
+            logging.info(f"Slicing for {', '.join(variables)}")
+
+            key = snapped_key(dataset_bucket)
+            if key is not None:
+                return cached_slice(key)
+            return self._slice(
+                dataset_id,
+                variables,
                 date,
                 long_lat,
                 depth,
-                params["has_depth"],
+                params.has_depth,
+                reduction,
+                selectors.get(params.has_depth),
             )
-        else:
+
+        # The subset parameters of the requests which are not memoized are
+        # shared by all the buckets, built once for each has_depth
+        selectors = {}
+        if not is_point_query and reduction is None:
+            for has_depth in {CMEMS._feature_params[w].has_depth for w in whats}:
+                selectors[has_depth] = _build_selectors(
+                    date, long_lat, depth, has_depth
+                )
+
+        # The point queries already memoized are resolved in place, only the
+        # remaining requests to the different datasets are issued concurrently
+        buckets = list(buckets.items())
+        bucket_results = [None] * len(buckets)
+        misses = []
+        for i, dataset_bucket in enumerate(buckets):
+            # The coordinates must already be loaded, not to fetch them here
+            key = dataset_bucket[0] in self.coordinates and snapped_key(dataset_bucket)
+            if key and key in self._sliced_keys:
+                bucket_results[i] = cached_slice(key)
+            else:
+                misses.append(i)
+        if len(misses) == 1:
+            bucket_results[misses[0]] = slice_bucket(buckets[misses[0]])
+        elif misses:
+            missed_results = utils.parallel_threads(
+                slice_bucket, [buckets[i] for i in misses], workers=len(misses)
+            )
+            for i, results in zip(misses, missed_results):
+                bucket_results[i] = results
+
+        values, infos = {}, {}
+        for (_, bucket), (results, selected_coordinates) in zip(
+            buckets, bucket_results
+        ):
+            for what in bucket:
+                variable = CMEMS._feature_params[what].variable
+                values[what] = results[variable]
+                infos[what] = selected_coordinates
+        return values, infos
+
+    def _snap_to_grid(self, params, long_lat, depth):
+        """
+        Return the closest (longitude, latitude) and depth on the grid
+        of the dataset, or None if the point lies outside of the grid
+        """
+        coords = self.get_coordinates(params.dataset_id)
+        longvals, latvals = coords["longitude"], coords["latitude"]
+        if not (
+            _within_grid(longvals, long_lat[0]) and _within_grid(latvals, long_lat[1])
+        ):
+            # Snapping would clamp the point to the edge of the grid, it is
+            # left to cmems to reject it
+            return None
+        long_lat = (
+            longvals[utils.nearest_indices(longvals, long_lat[0], is_sorted=False)],
+            latvals[utils.nearest_indices(latvals, long_lat[1], is_sorted=False)],
+        )
+        if params.has_depth:
+            depthvals = coords["depth"]
+            depth = depthvals[utils.nearest_indices(depthvals, depth, is_sorted=False)]
+        return long_lat, depth
+
+    def freeze(self, date: datetime.datetime, depth: float, what: str):
+        """
+        Return the feature sliced at the closest date and depth. The slices
+        are memoized, so that the repeated grid and ball queries at a fixed
+        date and depth only slice in longitude and latitude.
+
+        Args:
+            date: the date of the measures
+            depth: the depth of the measures
+            what: the name of the feature
+        """
+        params = CMEMS._feature_params.get(what)
+        if params is None:
             raise ValueError(
                 f"Does not know which dataset to download for the key {what}"
             )
+        _check_date_limit(what, params, date)
+        return self._cached_freeze(date, depth, what)
+
+    def _freeze(self, date, depth, what):
+        params = CMEMS._feature_params[what]
+        ds = self.fetch(params.dataset_id)
+        _check_date_end(what, ds, date)
+        values = ds[params.variable].sel(time=date, method="nearest")
+        if params.has_depth:
+            values = values.sel(depth=depth, method="nearest")
+        # The slab is downloaded once, not on every query of the frozen slice
+        values = values.load()
+        key_lon, key_lat = _spatial_keys(ds)
+        return FrozenSlice(values, key_lon, key_lat, params.has_depth)
+
+    def get_values_grid(
+        self,
+        date: datetime.datetime,
+        long_values: np.ndarray,
+        lat_values: np.ndarray,
+        depth: float,
+        what: str,
+    ):
+        """
+        Return the values of a feature at the closest grid points of many
+        (longitude, latitude) pairs, in a single vectorized selection
+
+        Args:
+            date: the date of the measures
+            long_values: array of degrees east
+            lat_values: array of degrees north, broadcastable with long_values
+            depth: the depth of the measures
+            what: the name of the feature
+        """
+        frozen = self.freeze(date, depth, what)
+        num_points = np.broadcast(long_values, lat_values).size
+        logging.info(f"Slicing for {what} on {num_points} points")
+        return frozen.get_grid(long_values, lat_values)
+
+    def interp(
+        self,
+        date: datetime.datetime,
+        long_values: np.ndarray,
+        lat_values: np.ndarray,
+        depth: float,
+        what: str,
+    ):
+        """
+        Return the values of a feature linearly interpolated in longitude,
+        latitude and depth at many (longitude, latitude) pairs, at the
+        closest date
+
+        Args:
+            date: the date of the measures
+            long_values: array of degrees east
+            lat_values: array of degrees north, broadcastable with long_values
+            depth: the depth of the measures
+            what: the name of the feature
+        """
+        params = CMEMS._feature_params.get(what)
+        if params is None:
+            raise ValueError(
+                f"Does not know which dataset to download for the key {what}"
+            )
+        _check_date_limit(what, params, date)
+
+        # Sparse grids, e.g. from np.meshgrid(..., sparse=True), are broadcasted
+        long_values, lat_values = np.broadcast_arrays(
+            np.asarray(long_values, dtype=float), np.asarray(lat_values, dtype=float)
+        )
+
+        logging.info(f"Interpolating {what} on {long_values.size} points")
+        ds = self.fetch(params.dataset_id)
+        _check_date_end(what, ds, date)
+        key_lon, key_lat = _spatial_keys(ds)
+        values = ds[params.variable].sel(time=date, method="nearest")
+        interp_coords = {
+            key_lon: xr.DataArray(long_values.ravel(), dims="points"),
+            key_lat: xr.DataArray(lat_values.ravel(), dims="points"),
+        }
+        selected_depth = float("nan")
+        if params.has_depth:
+            depthvals = values["depth"].values
+            if depthvals.min() <= depth <= depthvals.max():
+                interp_coords["depth"] = depth
+                selected_depth = depth
+            else:
+                # interp does not extrapolate, a depth out of the depth levels,
+                # e.g. at the surface above the first level, takes the closest one
+                values = values.sel(depth=depth, method="nearest")
+                selected_depth = values["depth"].values
+        values = values.interp(interp_coords, method="linear")
+
+        selected_coordinates = {
+            "time": values["time"].values,
+            "longitude": long_values,
+            "latitude": lat_values,
+            "depth": selected_depth,
+        }
+        return values.values.reshape(long_values.shape), selected_coordinates
+
+    def _get_tree(self, dataset_id, frozen):
+        if dataset_id not in self._trees:
+            # The tree is built from the coordinates of the opened dataset
+            # the nodes are ordered as the raveled (latitude, longitude) grid
+            long2d, lat2d = np.meshgrid(
+                frozen.values[frozen.key_lon].values,
+                frozen.values[frozen.key_lat].values,
+            )
+            self._trees[dataset_id] = cKDTree(np.c_[long2d.ravel(), lat2d.ravel()])
+        return self._trees[dataset_id]
+
+    def get_ball(
+        self,
+        date: datetime.datetime,
+        center: tuple[float, float],
+        radius: float,
+        depth: float,
+        what: str,
+    ):
+        """
+        Return the values of a feature at all the grid nodes within
+        a radius around a (longitude, latitude) center
+
+        Args:
+            date: the date of the measures
+            center: the (longitude, latitude) of the center of the ball
+            radius: the radius of the ball, in degrees
+            depth: the depth of the measures
+            what: the name of the feature
+        """
+        frozen = self.freeze(date, depth, what)
+        tree = self._get_tree(CMEMS._feature_params[what].dataset_id, frozen)
+
+        idx = np.asarray(tree.query_ball_point(center, r=radius), dtype=np.intp)
+        grid_shape = (
+            frozen.values.sizes[frozen.key_lat],
+            frozen.values.sizes[frozen.key_lon],
+        )
+        latidx, longidx = np.unravel_index(idx, grid_shape)
+        return frozen.get_nodes(longidx, latidx)
+
+
+class FrozenSlice(object):
+    """
+    A feature sliced at a fixed date and depth, which only remains
+    to be sliced in longitude and latitude
+    """
+
+    def __init__(self, values, key_lon, key_lat, has_depth):
+        self.values = values
+        self.key_lon = key_lon
+        self.key_lat = key_lat
+        self.has_depth = has_depth
+
+    def _selected_coordinates(self, values, shape):
+        return {
+            "time": values["time"].values,
+            "longitude": values[self.key_lon].values.reshape(shape),
+            "latitude": values[self.key_lat].values.reshape(shape),
+            "depth": values["depth"].values if self.has_depth else float("nan"),
+        }
+
+    def get_nodes(self, longidx: np.ndarray, latidx: np.ndarray):
+        """
+        Return the values at the grid nodes of the given
+        (longitude, latitude) indices
+        """
+        values = self.values.isel(
+            {
+                self.key_lon: xr.DataArray(longidx, dims="points"),
+                self.key_lat: xr.DataArray(latidx, dims="points"),
+            }
+        )
+        return values.values, self._selected_coordinates(values, (len(longidx),))
+
+    def get_grid(self, long_values: np.ndarray, lat_values: np.ndarray):
+        """
+        Return the values at the closest grid points of arrays of
+        (longitude, latitude), in a single vectorized selection
+        """
+        # Sparse grids, e.g. from np.meshgrid(..., sparse=True), are broadcasted
+        long_values, lat_values = np.broadcast_arrays(
+            np.asarray(long_values, dtype=float), np.asarray(lat_values, dtype=float)
+        )
+
+        # Pointwise selection of all the (longitude, latitude) pairs at once
+        values = self.values.sel(
+            {
+                self.key_lon: xr.DataArray(long_values.ravel(), dims="points"),
+                self.key_lat: xr.DataArray(lat_values.ravel(), dims="points"),
+            },
+            method="nearest",
+        )
+        return values.values.reshape(long_values.shape), self._selected_coordinates(
+            values, long_values.shape
+        )
@@ -64,7 +64,9 @@ def fetch_values():
         dataset = netCDF4.Dataset(filepath)
         longvals = dataset.variables["x"][:]
         latvals = dataset.variables["y"][:]
-        depthvals = dataset.variables["z"][:]
+        # The depths are integers in meters, float32 represents them exactly
+        # with half the memory of float64
+        depthvals = np.ascontiguousarray(dataset.variables["z"][:], dtype=np.float32)
         # Compute the detta in longitude/latitude, assuming
         # constant sampling in each direction
         dlongitude = longvals[1] - longvals[0]
@@ -74,8 +76,9 @@ def fetch_values():
         # restricting the values fetched
         # e.g. restricting to the mediterranean sea
         derivatives_depthvals = np.gradient(depthvals, dlongitude, dlatitude)
-        derivative_depthvals = np.sqrt(
-            derivatives_depthvals[0] ** 2 + derivatives_depthvals[1] ** 2
+        derivative_depthvals = np.ascontiguousarray(
+            np.sqrt(derivatives_depthvals[0] ** 2 + derivatives_depthvals[1] ** 2),
+            dtype=np.float32,
         )
         logging.debug(f"ETOPO1 netCDF dataset informations : \n {dataset}")
 
@@ -102,8 +105,8 @@ def get_value(longitude, latitude):
     assert (longvals.min() <= longitude <= longvals.max()) and (
         latvals.min() <= latitude <= latvals.max()
     )
-    longidx = np.fabs(longvals - longitude).argmin()
-    latidx = np.fabs(latvals - latitude).argmin()
+    longidx = utils.nearest_indices(longvals, longitude)
+    latidx = utils.nearest_indices(latvals, latitude)
     depth = depthvals[latidx, longidx]
     return depth, {"longitude": longvals[longidx], "latitude": latvals[latidx]}
 
@@ -120,12 +123,66 @@ def get_dvalue(longitude, latitude):
     assert (longvals.min() <= longitude <= longvals.max()) and (
         latvals.min() <= latitude <= latvals.max()
     )
-    longidx = np.fabs(longvals - longitude).argmin()
-    latidx = np.fabs(latvals - latitude).argmin()
+    longidx = utils.nearest_indices(longvals, longitude)
+    latidx = utils.nearest_indices(latvals, latitude)
     d_depth = derivative_depthvals[latidx, longidx]
     return d_depth, {"longitude": longvals[longidx], "latitude": latvals[latidx]}
 
 
+def get_values_grid(long_values, lat_values):
+    """
+    Return the depths from the closest longitude, latitude in etopo1
+    for arrays of points, in a single vectorized lookup
+
+    Args:
+        long_values : array of degrees east
+        lat_values : array of degrees north, broadcastable with long_values
+    """
+    fetch_values()
+    long_values = np.asarray(long_values)
+    lat_values = np.asarray(lat_values)
+    assert (longvals.min() <= long_values.min()) and (
+        long_values.max() <= longvals.max()
+    )
+    assert (latvals.min() <= lat_values.min()) and (lat_values.max() <= latvals.max())
+    longidx = utils.nearest_indices(longvals, long_values)
+    latidx = utils.nearest_indices(latvals, lat_values)
+    depths = depthvals[latidx, longidx]
+    return depths, {"longitude": longvals[longidx], "latitude": latvals[latidx]}
+
+
+def interp(long_values, lat_values):
+    """
+    Return the depths bilinearly interpolated in etopo1 for arrays of points
+
+    Args:
+        long_values : array of degrees east
+        lat_values : array of degrees north, broadcastable with long_values
+    """
+    fetch_values()
+    long_values = np.asarray(long_values)
+    lat_values = np.asarray(lat_values)
+    assert (longvals.min() <= long_values.min()) and (
+        long_values.max() <= longvals.max()
+    )
+    assert (latvals.min() <= lat_values.min()) and (lat_values.max() <= latvals.max())
+    # Indices of the grid cells containing the points
+    # and relative positions of the points within the cells
+    longidx = np.clip(np.searchsorted(longvals, long_values) - 1, 0, len(longvals) - 2)
+    latidx = np.clip(np.searchsorted(latvals, lat_values) - 1, 0, len(latvals) - 2)
+    wlong = (long_values - longvals[longidx]) / (
+        longvals[longidx + 1] - longvals[longidx]
+    )
+    wlat = (lat_values - latvals[latidx]) / (latvals[latidx + 1] - latvals[latidx])
+    depths = (
+        (1 - wlat) * (1 - wlong) * depthvals[latidx, longidx]
+        + (1 - wlat) * wlong * depthvals[latidx, longidx + 1]
+        + wlat * (1 - wlong) * depthvals[latidx + 1, longidx]
+        + wlat * wlong * depthvals[latidx + 1, longidx + 1]
+    )
+    return depths, {"longitude": long_values, "latitude": lat_values}
+
+
 def is_land(long_lat):
     # This is_land is pretty long,
     # prefer using the woa.is_land function
@@ -22,8 +22,10 @@ import urllib
 import shutil
 import gzip
 import logging
+from multiprocessing.dummy import Pool as ThreadPool
 
 # External imports
+import numpy as np
 import tqdm
 
 _BASEDIR = pathlib.Path.home() / ".medenv"
@@ -95,3 +97,34 @@ def download_and_extract(url, archivetype, name):
     _ARCHIVE_EXTRACTORS[archivetype](local_filename, f_out)
     logging.debug(f"Data extracted to {f_out}")
     return f_out
+
+
+def nearest_indices(vals, targets, is_sorted=True):
+    """
+    Return the indices of the closest elements of the array vals
+    for every element of targets
+
+    If vals may not be sorted in increasing order, e.g. the coordinates of
+    a dataset after dropping its duplicated indices, set is_sorted to False
+    """
+    vals = np.asarray(vals)
+    if len(vals) == 1:
+        return np.zeros(np.shape(targets), dtype=int)
+    if not is_sorted and np.any(vals[1:] < vals[:-1]):
+        order = np.argsort(vals, kind="stable")
+        return order[nearest_indices(vals[order], targets)]
+    idx = np.clip(np.searchsorted(vals, targets), 1, len(vals) - 1)
+    left_closer = np.fabs(targets - vals[idx - 1]) <= np.fabs(vals[idx] - targets)
+    return idx - left_closer
+
+
+def parallel_threads(f, args, workers=16):
+    """
+    Apply f on every element of args with a pool of threads. This is
+    suited to I/O bound functions, e.g. remote requests, for which the GIL
+    is released while waiting.
+
+    Returns the list of the results, in the same order as args
+    """
+    with ThreadPool(workers) as pool:
+        return pool.map(f, args)
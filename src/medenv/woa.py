@@ -25,6 +25,7 @@ import logging
 from datetime import datetime
 
 # External imports
+import numpy as np
 import pandas as pd
 
 # Local imports
@@ -151,6 +152,39 @@ def get_value(long_lat, depth, what, resolution=_DEFAULT_RESOLUTION):
     return data.loc[idx].iloc[depth_idx + 2]
 
 
+def get_values_grid(
+    long_values, lat_values, depth, what, resolution=_DEFAULT_RESOLUTION
+):
+    """
+    Return the values at the closest grid points of arrays of
+    (longitude, latitude), with a single vectorized lookup.
+
+    The points without measures, e.g. on land, are given a NaN value,
+    so that np.isnan of the result is the land mask.
+    """
+    data = fetch_values(datetime(year=2016, month=1, day=1), what, resolution)
+    depth_idx = abs(data.columns[2:] - depth).argmin()
+    # Build the latitude x longitude grid at the requested depth
+    # the missing grid points are filled in with NaN
+    # The rows and columns without any measure are missing from the pivot,
+    # it is reindexed on the full regular grid so that the closest node
+    # of a point is never taken across such a gap
+    grid = data.pivot(
+        index="latitude", columns="longitude", values=data.columns[depth_idx + 2]
+    ).reindex(
+        index=np.arange(-90 + resolution / 2, 90, resolution),
+        columns=np.arange(-180 + resolution / 2, 180, resolution),
+    )
+    grid_longvals = grid.columns.to_numpy()
+    grid_latvals = grid.index.to_numpy()
+    longidx = utils.nearest_indices(grid_longvals, np.asarray(long_values))
+    latidx = utils.nearest_indices(grid_latvals, np.asarray(lat_values))
+    return grid.to_numpy()[latidx, longidx], {
+        "longitude": grid_longvals[longidx],
+        "latitude": grid_latvals[latidx],
+    }
+
+
 def fetch_landsea():
     filename = "land_sea.msk"
     filename = utils._BASEDIR / filename
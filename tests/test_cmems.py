@@ -0,0 +1,146 @@
+# coding: utf-8
+"""
+This script belongs to the medenv package
+Copyright (C) 2022 Jeremy Fix
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Standard imports
+import datetime
+
+# External imports
+import numpy as np
+import pytest
+import requests
+import xarray as xr
+
+# Local imports
+from medenv import cmems
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(f"{status_code} error", response=response)
+
+
+@pytest.fixture
+def fetcher(monkeypatch, tmp_path):
+    # A CMEMS fetcher which never reaches the network
+    monkeypatch.setenv("CMEMS_USERNAME", "user")
+    monkeypatch.setenv("CMEMS_PASSWORD", "password")
+    monkeypatch.setattr(cmems.copernicusmarine, "login", lambda **kwargs: True)
+    monkeypatch.setattr(cmems.utils, "_BASEDIR", tmp_path)
+    monkeypatch.setattr(cmems.time, "sleep", lambda delay: None)
+    return cmems.CMEMS(num_retries=3, cache_coords=False)
+
+
+@pytest.mark.parametrize(
+    "error, transient",
+    [
+        (requests.ConnectionError("reset"), True),
+        (requests.Timeout("timeout"), True),
+        (TimeoutError(), True),
+        (http_error(503), True),
+        (http_error(429), True),
+        (http_error(401), False),
+        (http_error(404), False),
+        (ValueError("bad request"), False),
+        (KeyError("thetao"), False),
+    ],
+)
+def test_is_transient(error, transient):
+    assert cmems._is_transient(error) == transient
+
+
+def failing(errors):
+    # A request raising the given errors in turn before succeeding
+    calls = []
+
+    def f(**kwargs):
+        calls.append(kwargs)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return "values"
+
+    return f, calls
+
+
+def test_with_retries_transient(fetcher):
+    f, calls = failing([requests.ConnectionError(), http_error(503)])
+    assert fetcher._with_retries(f, dataset_id="med") == "values"
+    assert calls == [{"dataset_id": "med"}] * 3
+
+
+def test_with_retries_exhausted(fetcher):
+    f, calls = failing([requests.ConnectionError()] * 3)
+    with pytest.raises(requests.ConnectionError):
+        fetcher._with_retries(f)
+    # num_retries is the total number of attempts
+    assert len(calls) == 3
+
+
+def test_with_retries_permanent(fetcher):
+    f, calls = failing([http_error(401)])
+    with pytest.raises(requests.HTTPError):
+        fetcher._with_retries(f)
+    assert len(calls) == 1
+
+
+@pytest.fixture
+def chl_dataset(fetcher, monkeypatch):
+    # A small non square grid, the values encode their longitude and latitude
+    time = np.array(["2012-09-20", "2012-09-21"], dtype="datetime64[ns]")
+    depth = np.array([1.018, 5.0])
+    latitude = np.arange(40.0, 42.5, 0.5)
+    longitude = np.arange(10.0, 13.5, 0.5)
+    chl = np.broadcast_to(
+        1000 * longitude[None, :] + latitude[:, None],
+        (len(time), len(depth), len(latitude), len(longitude)),
+    )
+    ds = xr.Dataset(
+        {"chl": (("time", "depth", "latitude", "longitude"), chl)},
+        coords={
+            "time": time,
+            "depth": depth,
+            "latitude": latitude,
+            "longitude": longitude,
+        },
+    )
+    monkeypatch.setattr(cmems.copernicusmarine, "open_dataset", lambda dataset_id: ds)
+    return ds
+
+
+@pytest.mark.parametrize(
+    "center, radius", [((11.2, 41.1), 0.8), ((10.0, 40.0), 0.6), ((12.9, 42.4), 1.2)]
+)
+def test_get_ball(fetcher, chl_dataset, center, radius):
+    date = datetime.datetime(2012, 9, 21)
+    values, infos = fetcher.get_ball(date, center, radius, 3.0, "chlorophyl-a")
+
+    # The nodes of the ball, found by brute force
+    long2d, lat2d = np.meshgrid(chl_dataset.longitude, chl_dataset.latitude)
+    inside = (long2d - center[0]) ** 2 + (lat2d - center[1]) ** 2 <= radius**2
+    expected = sorted(zip(long2d[inside], lat2d[inside]))
+
+    assert sorted(zip(infos["longitude"], infos["latitude"])) == expected
+    np.testing.assert_allclose(values, 1000 * infos["longitude"] + infos["latitude"])
+
+
+def test_get_ball_empty(fetcher, chl_dataset):
+    date = datetime.datetime(2012, 9, 21)
+    values, infos = fetcher.get_ball(date, (20.0, 50.0), 0.5, 3.0, "chlorophyl-a")
+    assert values.shape == (0,)
+    assert infos["longitude"].shape == (0,)
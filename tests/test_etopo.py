@@ -0,0 +1,69 @@
+# coding: utf-8
+"""
+This script belongs to the medenv package
+Copyright (C) 2022 Jeremy Fix
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# External imports
+import numpy as np
+import pytest
+
+# Local imports
+from medenv import etopo
+
+
+@pytest.fixture
+def linear_grid(monkeypatch):
+    # A small grid on which the depth is linear in longitude and latitude
+    # so that the bilinear interpolation is exact
+    longvals = np.linspace(0.0, 10.0, 11)
+    latvals = np.linspace(0.0, 5.0, 6)
+    depthvals = (3 * latvals[:, None] + 2 * longvals[None, :]).astype(np.float32)
+    monkeypatch.setattr(etopo, "fetch_values", lambda: None)
+    monkeypatch.setattr(etopo, "longvals", longvals)
+    monkeypatch.setattr(etopo, "latvals", latvals)
+    monkeypatch.setattr(etopo, "depthvals", depthvals)
+
+
+def test_interp_linear(linear_grid):
+    long_values = np.array([0.5, 9.9, 10.0, 0.0])
+    lat_values = np.array([0.25, 4.5, 5.0, 0.0])
+    depths, infos = etopo.interp(long_values, lat_values)
+    np.testing.assert_allclose(depths, 2 * long_values + 3 * lat_values, rtol=1e-6)
+    np.testing.assert_array_equal(infos["longitude"], long_values)
+
+
+def test_interp_weights(linear_grid, monkeypatch):
+    depthvals = np.zeros((6, 11), dtype=np.float32)
+    depthvals[1, 2] = 1.0
+    monkeypatch.setattr(etopo, "depthvals", depthvals)
+    # A quarter of the cell from the node (long=2, lat=1) in each direction
+    depths, _ = etopo.interp(np.array([2.25, 1.75]), np.array([1.25, 0.75]))
+    np.testing.assert_allclose(depths, [0.75 * 0.75, 0.75 * 0.75])
+
+
+def test_interp_sparse_meshgrid(linear_grid):
+    long_values, lat_values = np.meshgrid([1.5, 7.25], [0.5, 2.0, 4.75], sparse=True)
+    depths, _ = etopo.interp(long_values, lat_values)
+    assert depths.shape == (3, 2)
+    np.testing.assert_allclose(depths, 2 * long_values + 3 * lat_values, rtol=1e-6)
+
+
+def test_get_values_grid_nearest(linear_grid):
+    depths, infos = etopo.get_values_grid(np.array([1.4, 1.6]), np.array([0.6, 0.4]))
+    np.testing.assert_array_equal(infos["longitude"], [1.0, 2.0])
+    np.testing.assert_array_equal(infos["latitude"], [1.0, 0.0])
+    np.testing.assert_array_equal(depths, [5.0, 4.0])
@@ -0,0 +1,56 @@
+# coding: utf-8
+"""
+This script belongs to the medenv package
+Copyright (C) 2022 Jeremy Fix
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# External imports
+import numpy as np
+
+# Local imports
+from medenv import utils
+
+
+def brute_force_nearest(vals, targets):
+    return np.fabs(vals[None, :] - targets[:, None]).argmin(axis=1)
+
+
+def test_nearest_indices_sorted():
+    vals = np.linspace(-180, 180, 721)
+    targets = np.array([-200.0, -180.0, -0.1, 0.0, 13.63, 179.9, 200.0])
+    idx = utils.nearest_indices(vals, targets)
+    np.testing.assert_array_equal(idx, brute_force_nearest(vals, targets))
+
+
+def test_nearest_indices_scalar():
+    vals = np.array([0.0, 1.0, 2.0])
+    assert utils.nearest_indices(vals, 1.4) == 1
+    assert utils.nearest_indices(vals, 1.6) == 2
+
+
+def test_nearest_indices_unsorted():
+    rng = np.random.default_rng(0)
+    vals = rng.permutation(np.linspace(0, 10, 101))
+    targets = rng.uniform(-1, 11, 50)
+    idx = utils.nearest_indices(vals, targets, is_sorted=False)
+    np.testing.assert_array_equal(vals[idx], vals[brute_force_nearest(vals, targets)])
+
+
+def test_nearest_indices_single_value():
+    vals = np.array([5.0])
+    np.testing.assert_array_equal(
+        utils.nearest_indices(vals, np.array([1.0, 9.0])), [0, 0]
+    )